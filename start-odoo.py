@@ -22,58 +22,174 @@
 import subprocess
 import sys
 import argparse
+import atexit
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
 from argparse import RawTextHelpFormatter
 
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
 DB_NAME = "testdb"
 DB_USER = "odoo"
 DB_PASSWORD = "odoo"
-ODOO_BIN_CMD = "source env17/bin/activate;cd community;./odoo-bin"
+ODOO_VENV = "env17"
+ODOO_DIR = "community"
+ODOO_BIN = "./odoo-bin"
 
 # ------------------------------------------------------------------------------
 # Misc Helpers
 # ------------------------------------------------------------------------------
 
 # https://www.geeksforgeeks.org/print-colors-python-terminal/
-COLOR_MAP = {"red": 91, "cyan": 96, "yellow": 93}
+_COLOR_PREFIX = {"red": "\033[91m", "cyan": "\033[96m", "yellow": "\033[93m"}
+_RESET = "\033[00m"
 
 
 def color(string: str, col: str) -> str:
     """
     return the input string wrapped in ansi color code corresponding to 'col'
     """
-    return f"\033[{COLOR_MAP[col]}m{string}\033[00m"
+    return _COLOR_PREFIX[col] + string + _RESET
 
 
 def run_command(command, cwd="./"):
-    return (
-        subprocess.run(command, cwd=cwd, capture_output=True, check=True)
-        .stdout.decode()
-        .rstrip("\n")
-    )
+    return subprocess.run(
+        command, cwd=cwd, capture_output=True, check=True, text=True
+    ).stdout.rstrip("\n")
+
+
+def run_command_nocapture(command, cwd="./", stderr=None):
+    """
+    run a command whose output is not needed (it goes directly to the terminal,
+    unless redirected with 'stderr')
+    """
+    subprocess.run(command, cwd=cwd, check=True, stderr=stderr)
+
+
+def run_lines(command, cwd="./"):
+    """
+    yield the output lines of a command as they are produced, without
+    buffering the whole output in memory
+    """
+    with subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, text=True) as proc:
+        for line in proc.stdout:
+            yield line.rstrip("\n")
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+def get_git_dir(cwd: str) -> str:
+    """
+    Return the git directory of a working directory. In a worktree (or
+    submodule), '.git' is a file pointing to the actual git directory
+    """
+    git_dir = os.path.join(cwd, ".git")
+    if os.path.isfile(git_dir):
+        with open(git_dir) as f:
+            pointer = f.readline().strip()
+        if not pointer.startswith("gitdir: "):
+            raise OSError(f"unexpected content in {git_dir}")
+        git_dir = os.path.join(cwd, pointer[len("gitdir: ") :])
+    return git_dir
+
+
+def read_head_branch(cwd: str) -> str:
+    """
+    Return the branch HEAD points to by reading it directly from the git
+    directory (empty string if HEAD is detached), without spawning git
+    """
+    try:
+        with open(os.path.join(get_git_dir(cwd), "HEAD")) as f:
+            head = f.readline().strip()
+    except OSError:
+        return run_command(["git", "branch", "--show-current"], cwd)
+    prefix = "ref: refs/heads/"
+    return head[len(prefix) :] if head.startswith(prefix) else ""
 
 
+def is_git_dirty(cwd: str) -> bool:
+    """
+    Return True if tracked files differ from HEAD. Untracked files are not
+    considered: this is much cheaper than a full 'git status' on big repos
+    """
+    # 'git diff' refreshes stat info in memory only, so touched but unchanged
+    # files are clean and the index is not written
+    try:
+        run_command(["git", "diff", "--quiet", "HEAD", "--"], cwd)
+    except subprocess.CalledProcessError as e:
+        if e.returncode == 1:
+            return True
+        raise
+    return False
+
+
+@functools.lru_cache(maxsize=8)
 def read_git_branch(cwd: str, with_status=False) -> str:
     """
-    Return current git branch in working directory
+    Return current git branch in working directory. With status, a (*) is
+    appended if tracked files have been modified
     """
-    branch_name = run_command(["git", "branch", "--show-current"], cwd)
+    branch_name = read_head_branch(cwd)
     if with_status:
-        is_dirty = run_command(["git", "status", "--porcelain"], cwd) != ""
-        if is_dirty:
+        if is_git_dirty(cwd):
             branch_name = branch_name + " (*)"
 
     return branch_name
 
 
+def read_git_branches(with_status=False):
+    """
+    Return current git branches of community and enterprise (fetched in parallel)
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        community = executor.submit(read_git_branch, "community", with_status)
+        enterprise = executor.submit(read_git_branch, "enterprise", with_status)
+        return community.result(), enterprise.result()
+
+
+_conn = None
+
+
+def run_query(query: str) -> tuple:
+    """
+    Run query on the test db and return its first row (as strings, like psql
+    -tA). Use an in-process connection if psycopg2 is available, otherwise
+    fall back to psql. Both connect with the same libpq defaults
+    """
+    global _conn
+    if psycopg2 is None:
+        return tuple(run_command(["psql", DB_NAME, "-tAc", query]).split("|"))
+    if _conn is None:
+        _conn = psycopg2.connect(dbname=DB_NAME)
+        atexit.register(_conn.close)
+    with _conn.cursor() as cr:
+        cr.execute(query)
+        return tuple("" if value is None else str(value) for value in cr.fetchone())
+
+
+def close_connection():
+    global _conn
+    if _conn is not None:
+        atexit.unregister(_conn.close)
+        _conn.close()
+        _conn = None
+
+
+@functools.lru_cache(maxsize=1)
 def get_db_version():
-    run_query = lambda q: run_command((["psql", DB_NAME, "-c", q]))
-    version_query = "SELECT latest_version FROM ir_module_module WHERE name='base'"
-    enterprise_query = "SELECT license from ir_module_module where name='web_enterprise' and state='installed'"
+    query = (
+        "SELECT "
+        "(SELECT latest_version FROM ir_module_module WHERE name='base'), "
+        "(SELECT count(*) FROM ir_module_module WHERE name='web_enterprise' AND state='installed')"
+    )
     try:
-        result_line = run_query(version_query).split()[2]
-        db_version = ".".join(result_line.split(".")[:2])
-        is_enterprise = "1 row" in run_query(enterprise_query)
-        if is_enterprise:
+        version, enterprise_count = run_query(query)
+        db_version = ".".join(version.split(".")[:2])
+        if enterprise_count != "0":
             db_version = db_version + " (enterprise)"
         return db_version
     except:
@@ -85,15 +201,37 @@ def get_db_version():
 # ------------------------------------------------------------------------------
 
 
+GIT_LIST_BRANCHES_CMD = [
+    "git",
+    "for-each-ref",
+    "--format=%(refname:lstrip=2)%00%(HEAD)",
+    "refs/heads/",
+]
+
+
+def read_repo_branches(repo: str):
+    """
+    Return a dict mapping each local branch of repo to whether it is checked out
+    """
+    branches = {}
+    for line in run_lines(GIT_LIST_BRANCHES_CMD, repo):
+        branch, head = line.split("\x00")
+        branches[branch] = head == "*"
+    return branches
+
+
+@functools.lru_cache(maxsize=1)
 def get_git_branches():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        community = executor.submit(read_repo_branches, "community")
+        enterprise = executor.submit(read_repo_branches, "enterprise")
+        community_branches = community.result()
+        enterprise_branches = enterprise.result()
+
     branches = {}
-    for branch in run_command(["git", "branch"], "community").split("\n"):
-        active = "* " in branch
-        branch = branch[2:].strip()
+    for branch, active in community_branches.items():
         branches[branch] = {"active": active, "com": active, "repo": ["community"]}
-    for branch in run_command(["git", "branch"], "enterprise").split("\n"):
-        active = "* " in branch
-        branch = branch[2:].strip()
+    for branch, active in enterprise_branches.items():
         if branch in branches:
             descr = branches[branch]
             descr["active"] = descr["active"] or active
@@ -104,25 +242,72 @@ def get_git_branches():
     return branches
 
 
+def parse_selection(answer: str, count: int):
+    """
+    Return the (0-based) indexes selected by the user, from a comma-separated
+    list of numbers (1-based) or 'all'
+    """
+    if answer.strip().lower() == "all":
+        return list(range(count))
+    indexes = []
+    for part in answer.split(","):
+        if part.strip():
+            error = ValueError(f"invalid branch number: {part.strip()}")
+            try:
+                index = int(part) - 1
+            except ValueError:
+                raise error from None
+            if not 0 <= index < count:
+                raise error
+            indexes.append(index)
+    # a branch given twice would make git refuse the whole 'git branch -D'
+    return list(dict.fromkeys(indexes))
+
+
 def branch_cleaner():
     branches = get_git_branches()
     print("Branch cleaner tool")
     print("-------------------")
-    print(f"Found {len(branches.keys())} branches\n")
+    print(f"Found {len(branches)} branches\n")
+    candidates = []
     for branch, descr in branches.items():
         color_branch_name = color(branch, "cyan")
         if descr["active"]:
             print(f"skipping '{color_branch_name}' (currently in use)")
         else:
-            should_remove = (
-                input(
-                    f"remove '{color_branch_name}' ({', '.join(descr['repo'])})? (y/N) "
-                )
-                == "y"
+            candidates.append(branch)
+            index = len(candidates)
+            print(f"{index:>3}. '{color_branch_name}' ({', '.join(descr['repo'])})")
+
+    if not candidates:
+        return
+    answer = input("enter comma-separated numbers to delete (or 'all'): ")
+    try:
+        selection = parse_selection(answer, len(candidates))
+    except ValueError as e:
+        print(color(f"Error: {e}", "red"))
+        return
+
+    # one 'git branch -D' per repo: deleting branches concurrently in the same
+    # repo could conflict on the packed-refs lock
+    to_delete = {"community": [], "enterprise": []}
+    for index in selection:
+        branch = candidates[index]
+        for repo in branches[branch]["repo"]:
+            to_delete[repo].append(branch)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {
+            repo: executor.submit(
+                run_command_nocapture, ["git", "branch", "-D", *names], repo
             )
-            if should_remove:
-                for repo in descr["repo"]:
-                    print(run_command(["git", "branch", "-D", branch], repo))
+            for repo, names in to_delete.items()
+            if names
+        }
+        for repo, future in futures.items():
+            try:
+                future.result()
+            except subprocess.CalledProcessError as e:
+                print(color(f"Error: failed to delete branches in {repo}: {e}", "red"))
 
 
 def get_branch_status(descr):
@@ -146,13 +331,23 @@ def show_branches():
 # ------------------------------------------------------------------------------
 
 
-def show_status():
-    sys.path.append("community/odoo")
-    import release
+def get_odoo_version():
+    """
+    Return the version of the odoo server in community (imported lazily, only
+    needed for the status command)
+    """
+    if "community/odoo" not in sys.path:
+        sys.path.insert(0, "community/odoo")
+    try:
+        import release
+    except ImportError:
+        return "?"
+    return release.version
 
-    community_branch = read_git_branch("community", with_status=True)
-    enterprise_branch = read_git_branch("enterprise", with_status=True)
-    print("{:<18} {}".format("Odoo server:", release.version))
+
+def show_status():
+    community_branch, enterprise_branch = read_git_branches(with_status=True)
+    print("{:<18} {}".format("Odoo server:", get_odoo_version()))
     print("{:<18} {}".format(f"{DB_NAME} version:", get_db_version()))
     print("{:<18} {}".format("Community branch:", community_branch))
     print("{:<18} {}".format("Enterprise branch:", enterprise_branch))
@@ -164,12 +359,15 @@ def show_status():
 
 
 def drop_test_db():
+    close_connection()
     try:
-        run_command(["dropdb", DB_NAME])
+        # dropdb error is hidden, the warning below is enough
+        run_command_nocapture(["dropdb", DB_NAME], stderr=subprocess.DEVNULL)
+        get_db_version.cache_clear()
     except:
         print(
             color(
-                "warning: failed to drop test db (db probably does not exist", "yellow"
+                "warning: failed to drop test db (db probably does not exist)", "yellow"
             )
         )
 
@@ -179,11 +377,21 @@ def drop_test_db():
 # ------------------------------------------------------------------------------
 
 
-def start_odoo(args: str):
+def start_odoo(args: list):
     """
-    start a odoo server with the corresponding addons path and args
+    start a odoo server with the corresponding addons path and args. The
+    current process is replaced by odoo-bin, running in the virtual env
     """
-    subprocess.call(f"{ODOO_BIN_CMD} {args}", shell=True, executable="/bin/bash")
+    venv = os.path.abspath(ODOO_VENV)
+    os.environ["VIRTUAL_ENV"] = venv
+    os.environ["PATH"] = os.path.join(venv, "bin") + os.pathsep + os.environ["PATH"]
+    os.environ.pop("PYTHONHOME", None)
+    os.chdir(ODOO_DIR)
+    # exec does not run any python cleanup: close connection and flush output
+    close_connection()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(ODOO_BIN, [ODOO_BIN, *args])
 
 
 # ------------------------------------------------------------------------------
@@ -191,61 +399,63 @@ def start_odoo(args: str):
 # ------------------------------------------------------------------------------
 
 
+_PARSER = argparse.ArgumentParser(
+    description="GED odoo commander script",
+    epilog=__doc__,
+    formatter_class=RawTextHelpFormatter,
+)
+_PARSER.add_argument(
+    "-e", "--enterprise", help="activate enterprise addons", action="store_true"
+)
+_PARSER.add_argument("-t", "--test", help="run tests", action="store_true")
+_PARSER.add_argument("-d", "--drop-db", help="drop test db", action="store_true")
+_PARSER.add_argument(
+    "--clean-branches", help="helper to clean all git branches", action="store_true"
+)
+_PARSER.add_argument(
+    "-l", "--list-branches", help="list all git branches", action="store_true"
+)
+_PARSER.add_argument(
+    "-w",
+    "--test-web",
+    help="run web test suite (implies --test)",
+    action="store_true",
+)
+_PARSER.add_argument("-p", "--additional-path", help="additional addon path")
+_PARSER.add_argument(
+    "-s",
+    "--status",
+    help="show Odoo version and current branches",
+    action="store_true",
+)
+_PARSER.add_argument(
+    "odoo_args", nargs="*", help="args given to odoo server (after '--')"
+)
+
+
 def parse_args():
-    args = sys.argv[1:]
-    odoo_args = []
-
-    for i, val in enumerate(args):
-        if val == "--":
-            odoo_args = args[i + 1 :]
-            args = args[:i]
-
-    parser = argparse.ArgumentParser(
-        description="GED odoo commander script",
-        epilog=__doc__,
-        formatter_class=RawTextHelpFormatter,
-    )
-    parser.add_argument(
-        "-e", "--enterprise", help="activate enterprise addons", action="store_true"
-    )
-    parser.add_argument("-t", "--test", help="run tests", action="store_true")
-    parser.add_argument("-d", "--drop-db", help="drop test db", action="store_true")
-    parser.add_argument(
-        "--clean-branches", help="helper to clean all git branches", action="store_true"
-    )
-    parser.add_argument(
-        "-l", "--list-branches", help="list all git branches", action="store_true"
-    )
-    parser.add_argument(
-        "-w",
-        "--test-web",
-        help="run web test suite (implies --test)",
-        action="store_true",
-    )
-    parser.add_argument("-p", "--additional-path", help="additional addon path")
-    parser.add_argument(
-        "-s",
-        "--status",
-        help="show Odoo version and current branches",
-        action="store_true",
-    )
-    return (parser.parse_args(args), odoo_args)
+    """
+    Return the parsed config, and the args given to odoo server
+    """
+    config = _PARSER.parse_args()
+    return (config, config.odoo_args)
 
 
 def main():
     config, odoo_args = parse_args()
 
+    # git/status commands do not need the db sanity checks below
     if config.status:
         show_status()
-        quit()
+        return
 
     if config.clean_branches:
         branch_cleaner()
-        quit()
+        return
 
     if config.list_branches:
         show_branches()
-        quit()
+        return
 
     if config.drop_db:
         drop_test_db()
@@ -253,10 +463,10 @@ def main():
     if config.test_web:
         config.test = True
 
-    # sanity check: do enterprise and community branch match?
-    if config.enterprise:
-        community_branch = read_git_branch("community")
-        enterprise_branch = read_git_branch("enterprise")
+    # sanity check: do enterprise and community branch match? (skipped with
+    # --drop-db, to start the server as fast as possible)
+    if config.enterprise and not config.drop_db:
+        community_branch, enterprise_branch = read_git_branches()
 
         if community_branch != enterprise_branch:
             print(
@@ -268,33 +478,33 @@ def main():
             )
             should_stop = input("do you want to continue? (Y/n) ") == "n"
             if should_stop:
-                quit()
+                return
 
     # another check: error if db does not match enterprise config
-    is_db_enterprise = "enterprise" in get_db_version()
-    if not config.drop_db and is_db_enterprise != config.enterprise:
-        msg = (
-            "Error: no enterprise addons requested, but current db is enterprise"
-            if is_db_enterprise
-            else "Error: enterprise addons requested, but current db is not enterprise"
-        )
-        print(color(msg, "red"))
-        quit()
+    if not config.drop_db:
+        is_db_enterprise = "enterprise" in get_db_version()
+        if is_db_enterprise != config.enterprise:
+            msg = (
+                "Error: no enterprise addons requested, but current db is enterprise"
+                if is_db_enterprise
+                else "Error: enterprise addons requested, but current db is not enterprise"
+            )
+            print(color(msg, "red"))
+            return
 
     # start odoo server
     addons_path = "addons,../enterprise" if config.enterprise else "addons"
     if config.additional_path:
         addons_path = addons_path + "," + config.additional_path
 
-    base_args = f" -r {DB_USER} -w {DB_PASSWORD} -d {DB_NAME} --db-filter={DB_NAME} --dev=all --addons-path {addons_path} "
+    args = ["-r", DB_USER, "-w", DB_PASSWORD, "-d", DB_NAME]
+    args += [f"--db-filter={DB_NAME}", "--dev=all", "--addons-path", addons_path]
 
     if config.test:
-        test_args = " --test-enable --stop-after-init "
+        args += ["--test-enable", "--stop-after-init"]
         if config.test_web:
-            test_args = test_args + "--test-tags /web:WebSuite "
-        start_odoo(base_args + test_args + " ".join(odoo_args))
-    else:
-        start_odoo(base_args + " " + " ".join(odoo_args))
+            args += ["--test-tags", "/web:WebSuite"]
+    start_odoo(args + odoo_args)
 
 
 if __name__ == "__main__":